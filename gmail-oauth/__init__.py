@@ -7,15 +7,31 @@ Stores credentials in HACM for secure persistence.
 from __future__ import annotations
 
 import base64
-import hashlib
-import json
-import os
-from datetime import datetime
-from pathlib import Path
-from urllib.parse import urlencode, urlparse, parse_qs
+import hmac
+import html
+import secrets
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timezone
+from urllib.parse import urlencode, urlsplit, parse_qs
 
 import requests
+from requests.adapters import HTTPAdapter
 from typing import Literal
+from urllib3.util.retry import Retry
+
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    from json import loads as _json_loads
+
+try:
+    from hacm import Credential, CredentialStore
+
+    _HACM_AVAILABLE = True
+except ImportError:
+    _HACM_AVAILABLE = False
 
 # Configuration
 GOOGLE_AUTH_URI = "https://accounts.google.com/o/oauth2/auth"
@@ -25,6 +41,39 @@ GOOGLE_SCOPES = [
     "https://www.googleapis.com/auth/gmail.modify",  # Modify labels (optional)
 ]
 
+# Token endpoint (connect, read) timeouts in seconds
+TOKEN_TIMEOUT = (3.05, 10)
+
+# Callback response pages
+_SUCCESS_HTML = (
+    b"<html><body><h1>Authorization successful!</h1>"
+    b"<p>You can close this window.</p></body></html>"
+)
+_FAILED_HTML_PREFIX = b"<html><body><h1>Authorization failed</h1><p>Error: "
+_FAILED_HTML_SUFFIX = b"</p></body></html>"
+_STATE_MISMATCH_HTML = _FAILED_HTML_PREFIX + b"state_mismatch" + _FAILED_HTML_SUFFIX
+_INVALID_HTML = b"<html><body><h1>Invalid request</h1></body></html>"
+
+# Query-string fragment shared by every authorization URL
+_STATIC_AUTH_QUERY = urlencode({"scope": " ".join(GOOGLE_SCOPES), "response_type": "code"})
+
+
+def iter_google_credentials(store, cred_type: str | None = None):
+    """Yield (cred_id, cred) pairs for Google credentials in a HACM store.
+
+    Credential IDs have the form ``<provider>:<account_id>``, so other
+    providers are skipped on the ID alone without inspecting the credential.
+
+    Args:
+        store: HACM CredentialStore
+        cred_type: Only yield credentials of this type (e.g. "oauth_refresh")
+    """
+    for cred_id, cred in store.list():
+        if not cred_id.startswith("google:"):
+            continue
+        if cred_type is None or cred.type == cred_type:
+            yield cred_id, cred
+
 
 class GmailOAuthClient:
     """Minimal GMail OAuth 2.0 client for headless systems."""
@@ -48,31 +97,64 @@ class GmailOAuthClient:
         self.redirect_uri = redirect_uri
         self._client_id = client_id
         self._client_secret = client_secret
+        self._session = self._create_session()
+        # account_id -> (access_token, monotonic expiry)
+        self._access_cache: dict[str, tuple[str, float]] = {}
+        # account_id -> pending refresh shared by concurrent callers
+        self._refresh_inflight: dict[str, Future] = {}
+        self._refresh_lock = threading.Lock()
+
+    def __enter__(self) -> GmailOAuthClient:
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Close pooled HTTP connections to the token endpoint."""
+        self._session.close()
+
+    def _open_store(self):
+        """Open the HACM credential store for a single operation.
+
+        The store is not kept between operations: other processes (the CLI,
+        store_client.py) rewrite the credential file, and a stale store would
+        miss their entries and drop them on its next put().
+        """
+        if not _HACM_AVAILABLE:
+            raise ImportError("HACM not installed: pip install memogarden-hacm")
+        return CredentialStore(self.hacm_path)
+
+    @staticmethod
+    def _create_session() -> requests.Session:
+        """Create a keep-alive session so repeated token calls reuse TLS connections."""
+        session = requests.Session()
+        # Only retry failed connects: once Google has seen a request it is never
+        # resent, since authorization codes are single-use. raise_on_status=False
+        # leaves error responses to raise_for_status() in the caller.
+        retry = Retry(total=3, connect=3, read=0, status=0, other=0, backoff_factor=0.3, raise_on_status=False)
+        session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retry))
+        return session
 
     def get_client_credentials(self) -> tuple[str, str]:
-        """Get OAuth client credentials (from HACM or constructor)."""
+        """Get OAuth client credentials (from constructor, or HACM on first call)."""
         if self._client_id and self._client_secret:
             return self._client_id, self._client_secret
 
         # Load from HACM
-        try:
-            from hacm import CredentialStore
-
-            store = CredentialStore(self.hacm_path)
-            client_cred = store.get("google:oauth-client")
-            if not client_cred:
-                raise ValueError(
-                    "OAuth client credentials not found in HACM. "
-                    "Add them using `hacm-credentials add-client` or via API."
-                )
-
-            # Decode client credentials
-            import base64
-            creds_data = json.loads(base64.b64decode(client_cred.material).decode("utf-8"))
-            return creds_data["client_id"], creds_data["client_secret"]
-
-        except ImportError:
-            raise ImportError("HACM not installed: pip install memogarden-hacm")
+        store = self._open_store()
+        client_cred = store.get("google:oauth-client")
+        if not client_cred:
+            raise ValueError(
+                "OAuth client credentials not found in HACM. "
+                "Add them using `hacm-credentials add-client` or via API."
+            )
+
+        # Decode client credentials once; later calls take the fast path above
+        creds_data = _json_loads(base64.b64decode(client_cred.material))
+        self._client_id = creds_data["client_id"]
+        self._client_secret = creds_data["client_secret"]
+        return self._client_id, self._client_secret
 
     def get_authorization_url(
         self,
@@ -80,6 +162,7 @@ class GmailOAuthClient:
         access_type: Literal["online", "offline"] = "offline",
         prompt: Literal["consent", "select_account"] = "consent",
         use_oob: bool = False,
+        redirect_uri: str | None = None,
     ) -> str:
         """Generate GMail OAuth authorization URL.
 
@@ -88,6 +171,7 @@ class GmailOAuthClient:
             access_type: "offline" for refresh token (required)
             prompt: "consent" to force approval screen
             use_oob: Use out-of-band flow (oob) for headless/CLI usage
+            redirect_uri: Callback URI override (defaults to self.redirect_uri)
 
         Returns:
             Authorization URL for user to visit
@@ -95,25 +179,23 @@ class GmailOAuthClient:
         client_id, _ = self.get_client_credentials()
 
         if state is None:
-            state = self._generate_state()
+            state = self.generate_state()
 
         # Choose redirect URI based on flow type
         if use_oob:
             redirect_uri = "urn:ietf:wg:oauth:2.0:oob"  # OOB flow for headless
-        else:
+        elif redirect_uri is None:
             redirect_uri = self.redirect_uri  # Callback flow
 
         params = {
             "client_id": client_id,
             "redirect_uri": redirect_uri,
-            "scope": " ".join(GOOGLE_SCOPES),
-            "response_type": "code",
             "access_type": access_type,
             "prompt": prompt,
             "state": state,
         }
 
-        url = f"{GOOGLE_AUTH_URI}?{urlencode(params)}"
+        url = f"{GOOGLE_AUTH_URI}?{urlencode(params)}&{_STATIC_AUTH_QUERY}"
         return url
 
     def exchange_code_for_tokens(self, code: str, redirect_uri: str | None = None, state: str | None = None) -> dict:
@@ -144,10 +226,10 @@ class GmailOAuthClient:
             "grant_type": "authorization_code",
         }
 
-        response = requests.post(GOOGLE_TOKEN_URI, data=data)
+        response = self._session.post(GOOGLE_TOKEN_URI, data=data, timeout=TOKEN_TIMEOUT)
         response.raise_for_status()
 
-        tokens = response.json()
+        tokens = _json_loads(response.content)
 
         if "error" in tokens:
             raise ValueError(f"Token exchange failed: {tokens.get('error')}: {tokens.get('error_description')}")
@@ -164,32 +246,26 @@ class GmailOAuthClient:
             account_id: GMail account identifier (e.g., "user@gmail.com")
             tokens: Token response from exchange_code_for_tokens
         """
-        try:
-            from hacm import Credential, CredentialStore
-            from datetime import datetime
-
-            store = CredentialStore(self.hacm_path)
-
-            # Create credential
-            cred = Credential(
-                id=f"google:{account_id}",
-                provider="google",
-                account_id=account_id,
-                type="oauth_refresh",
-                material=tokens["refresh_token"],
-                metadata={
-                    "scopes": tokens.get("scope", "").split(),
-                    "token_endpoint": GOOGLE_TOKEN_URI,
-                    "access_expires_in": tokens.get("expires_in"),
-                },
-                created_at=datetime.utcnow(),
-                updated_at=datetime.utcnow(),
-            )
-
-            store.put(f"google:{account_id}", cred)
-
-        except ImportError:
-            raise ImportError("HACM not installed: pip install memogarden-hacm")
+        store = self._open_store()
+        now = datetime.now(timezone.utc)
+
+        # Create credential
+        cred = Credential(
+            id=f"google:{account_id}",
+            provider="google",
+            account_id=account_id,
+            type="oauth_refresh",
+            material=tokens["refresh_token"],
+            metadata={
+                "scopes": tokens.get("scope", "").split(),
+                "token_endpoint": GOOGLE_TOKEN_URI,
+                "access_expires_in": tokens.get("expires_in"),
+            },
+            created_at=now,
+            updated_at=now,
+        )
+
+        store.put(f"google:{account_id}", cred)
 
     def get_refresh_token(self, account_id: str) -> str:
         """Retrieve stored refresh token for account.
@@ -203,23 +279,20 @@ class GmailOAuthClient:
         Raises:
             ValueError: If token not found in HACM
         """
-        try:
-            from hacm import CredentialStore
-
-            store = CredentialStore(self.hacm_path)
-            cred = store.get(f"google:{account_id}")
-
-            if not cred:
-                raise ValueError(f"No refresh token found for {account_id}")
+        store = self._open_store()
+        cred = store.get(f"google:{account_id}")
 
-            return cred.material
+        if not cred:
+            raise ValueError(f"No refresh token found for {account_id}")
 
-        except ImportError:
-            raise ImportError("HACM not installed: pip install memogarden-hacm")
+        return cred.material
 
     def refresh_access_token(self, account_id: str) -> dict:
         """Refresh access token using stored refresh token.
 
+        Concurrent calls for the same account share a single request to the
+        token endpoint, so the refresh token is never presented twice at once.
+
         Args:
             account_id: GMail account identifier
 
@@ -229,6 +302,30 @@ class GmailOAuthClient:
         Raises:
             ValueError: If refresh fails
         """
+        with self._refresh_lock:
+            future = self._refresh_inflight.get(account_id)
+            is_owner = future is None
+            if is_owner:
+                future = Future()
+                self._refresh_inflight[account_id] = future
+
+        if not is_owner:
+            return future.result()
+
+        try:
+            tokens = self._request_refresh(account_id)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(tokens)
+            return tokens
+        finally:
+            with self._refresh_lock:
+                del self._refresh_inflight[account_id]
+
+    def _request_refresh(self, account_id: str) -> dict:
+        """POST the stored refresh token to the token endpoint."""
         refresh_token = self.get_refresh_token(account_id)
         client_id, client_secret = self.get_client_credentials()
 
@@ -239,10 +336,10 @@ class GmailOAuthClient:
             "grant_type": "refresh_token",
         }
 
-        response = requests.post(GOOGLE_TOKEN_URI, data=data)
+        response = self._session.post(GOOGLE_TOKEN_URI, data=data, timeout=TOKEN_TIMEOUT)
         response.raise_for_status()
 
-        tokens = response.json()
+        tokens = _json_loads(response.content)
 
         if "error" in tokens:
             raise ValueError(f"Token refresh failed: {tokens.get('error')}: {tokens.get('error_description')}")
@@ -253,12 +350,77 @@ class GmailOAuthClient:
 
         return tokens
 
+    def refresh_all(self, account_ids: list[str], max_workers: int = 8) -> dict[str, dict | Exception]:
+        """Refresh access tokens for several accounts concurrently.
+
+        Requests share the client's pooled session, so N refreshes take roughly
+        one round trip instead of N. Successful refreshes populate the access
+        token cache used by get_valid_access_token().
+
+        Args:
+            account_ids: GMail account identifiers
+            max_workers: Maximum concurrent refresh requests
+
+        Returns:
+            Dict mapping account_id to its token response, or to the exception
+            raised while refreshing it
+        """
+        results: dict[str, dict | Exception] = {}
+        if not account_ids:
+            return results
+
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(account_ids))) as pool:
+            futures = {pool.submit(self._refresh_and_cache, a): a for a in account_ids}
+            for future, account_id in futures.items():
+                try:
+                    results[account_id] = future.result()
+                except Exception as e:
+                    results[account_id] = e
+
+        return results
+
+    def get_valid_access_token(self, account_id: str, skew_seconds: int = 90) -> str:
+        """Get an access token, refreshing only when the cached one is near expiry.
+
+        Args:
+            account_id: GMail account identifier
+            skew_seconds: Refresh this many seconds before the token expires
+
+        Returns:
+            Access token valid for at least skew_seconds
+
+        Raises:
+            ValueError: If refresh fails
+        """
+        # Access tokens are cached in memory only: HACM Credential File Schema v3
+        # forbids persisting access tokens or any other secret in metadata.
+        cached = self._access_cache.get(account_id)
+        if cached is not None:
+            access_token, expires_at = cached
+            if time.monotonic() < expires_at - skew_seconds:
+                return access_token
+
+        return self._refresh_and_cache(account_id)["access_token"]
+
+    def _refresh_and_cache(self, account_id: str) -> dict:
+        """Refresh the access token and record it in the access token cache."""
+        tokens = self.refresh_access_token(account_id)
+        expires_at = time.monotonic() + tokens.get("expires_in", 0)
+        self._access_cache[account_id] = (tokens["access_token"], expires_at)
+        return tokens
+
     @staticmethod
-    def _generate_state() -> str:
-        """Generate random state parameter for CSRF protection."""
-        import secrets
+    def generate_state() -> str:
+        """Generate random state parameter for CSRF protection.
+
+        Callers that need to verify the callback generate the state with this
+        and pass it to get_authorization_url().
+        """
         return secrets.token_urlsafe(16)
 
+    # Kept for existing callers of the former private name
+    _generate_state = generate_state
+
 
 class SimpleCallbackServer:
     """Minimal HTTP server for OAuth callback on headless systems.
@@ -266,16 +428,26 @@ class SimpleCallbackServer:
     For production, consider using a proper web framework.
     """
 
-    def __init__(self, port: int = 8080):
+    def __init__(self, port: int = 8080, expected_state: str | None = None):
         """Initialize callback server.
 
         Args:
             port: Port to listen on
+            expected_state: State issued with the authorization URL; callbacks
+                carrying a different (or no) state are rejected
         """
         self.port = port
+        self.expected_state = expected_state
         self._code: str | None = None
         self._state: str | None = None
         self._error: str | None = None
+        self._done = threading.Event()
+
+    def _state_matches(self, received: str) -> bool:
+        """Check the callback state against the expected one in constant time."""
+        if self.expected_state is None:
+            return True
+        return hmac.compare_digest(received.encode(), self.expected_state.encode())
 
     def wait_for_callback(self, timeout: int = 300) -> dict:
         """Start server and wait for OAuth callback.
@@ -289,67 +461,77 @@ class SimpleCallbackServer:
         Raises:
             TimeoutError: If no callback within timeout
         """
-        from http.server import HTTPServer, BaseHTTPRequestHandler
-        import socket
-        import threading
-        import time
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+        outer = self
 
         class CallbackHandler(BaseHTTPRequestHandler):
             """Handle OAuth callback."""
 
-            def __init__(self, outer):
-                super().__init__()
-                self.outer = outer
+            def _send_html(self, status: int, body: bytes) -> None:
+                """Send a complete HTML response with an explicit length."""
+                self.send_response(status)
+                self.send_header("Content-type", "text/html")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
 
             def do_GET(self):
                 """Handle GET request for OAuth callback."""
-                # Parse query string
-                parsed = urlparse(self.path)
-                params = parse_qs(parsed.query)
-
-                if "code" in params:
-                    self.outer._code = params["code"][0]
-                    if "state" in params:
-                        self.outer._state = params["state"][0]
-
-                    # Send success response
-                    self.send_response(200)
-                    self.send_header("Content-type", "text/html")
-                    self.end_headers()
-                    self.wfile.write(
-                        b"<html><body><h1>Authorization successful!</h1>"
-                        b"<p>You can close this window.</p></body></html>"
-                    )
-                elif "error" in params:
-                    self.outer._error = params["error"][0]
-                    if "error_description" in params:
-                        self.outer._error += f": {params['error_description'][0]}"
-
-                    # Send error response
-                    self.send_response(400)
-                    self.send_header("Content-type", "text/html")
-                    self.end_headers()
-                    self.wfile.write(
-                        b"<html><body><h1>Authorization failed</h1>"
-                        b"<p>Error: " + self.outer._error.encode() + b"</p></body></html>"
-                    )
+                # Parse query string once; a real callback has only a few fields
+                try:
+                    params = parse_qs(urlsplit(self.path).query, max_num_fields=16)
+                except ValueError:
+                    params = {}
+                code = params.get("code", (None,))[0]
+                state = params.get("state", (None,))[0]
+                error = params.get("error", (None,))[0]
+                error_description = params.get("error_description", (None,))[0]
+
+                if code is not None and not outer._state_matches(state or ""):
+                    # Reject before the code is kept, so no token exchange happens
+                    outer._error = "state_mismatch"
+                    self._send_html(400, _STATE_MISMATCH_HTML)
+                    outer._done.set()
+                elif code is not None:
+                    outer._code = code
+                    outer._state = state
+
+                    self._send_html(200, _SUCCESS_HTML)
+                    outer._done.set()
+                elif error is not None:
+                    outer._error = error
+                    if error_description is not None:
+                        outer._error += f": {error_description}"
+
+                    # The error text comes from the query string, so escape it
+                    body = b"".join((
+                        _FAILED_HTML_PREFIX,
+                        html.escape(outer._error).encode(),
+                        _FAILED_HTML_SUFFIX,
+                    ))
+                    self._send_html(400, body)
+                    outer._done.set()
                 else:
-                    self.send_response(400)
-                    self.send_header("Content-type", "text/html")
-                    self.end_headers()
-                    self.wfile.write(b"<html><body><h1>Invalid request</h1></body></html>")
+                    # Stray requests (e.g. /favicon.ico) don't end the wait
+                    self._send_html(400, _INVALID_HTML)
 
-                # Shutdown server after processing request
-                threading.Thread(target=self.server.shutdown, daemon=True).start()
-
-        # Start server
-        server = HTTPServer(("localhost", self.port), CallbackHandler(self))
-        server.timeout = timeout
+        # Serve on a background thread; the main thread waits on the done event
+        server = ThreadingHTTPServer(("localhost", self.port), CallbackHandler)
+        server.daemon_threads = True
+        server_thread = threading.Thread(
+            target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True
+        )
 
         print(f"Listening for OAuth callback on http://localhost:{self.port}")
         print("Waiting for authorization...")
 
-        server.handle_request()
+        server_thread.start()
+        try:
+            self._done.wait(timeout)
+        finally:
+            server.shutdown()
+            server.server_close()
 
         if self._code:
             return {"code": self._code, "state": self._state}
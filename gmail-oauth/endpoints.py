@@ -3,16 +3,40 @@
 This module provides minimal Flask endpoints for OAuth flow integration.
 """
 
+import threading
+from collections import OrderedDict
+
 from flask import Blueprint, request, jsonify
 
-from gmail_oauth import GmailOAuthClient
+from gmail_oauth import GmailOAuthClient, iter_google_credentials
 
 bp = Blueprint("gmail_oauth", __name__, url_prefix="/api/v1/oauth/gmail")
 
 
-def get_client(hacm_path: str = "/var/lib/hacm/credentials.enc"):
-    """Get OAuth client instance."""
-    return GmailOAuthClient(hacm_path)
+# Clients shared across requests, most recently used last
+_MAX_CLIENTS = 8
+_clients: OrderedDict[str, GmailOAuthClient] = OrderedDict()
+_clients_lock = threading.Lock()
+
+
+def get_client(hacm_path: str = "/var/lib/hacm/credentials.enc") -> GmailOAuthClient:
+    """Get the OAuth client shared by all requests for this HACM path.
+
+    Sharing the client reuses its decoded client credentials and pooled
+    connections to the token endpoint; the HACM store itself is still opened
+    per operation. The least recently used client is closed when evicted.
+    """
+    with _clients_lock:
+        client = _clients.get(hacm_path)
+        if client is not None:
+            _clients.move_to_end(hacm_path)
+            return client
+
+        client = _clients[hacm_path] = GmailOAuthClient(hacm_path)
+        if len(_clients) > _MAX_CLIENTS:
+            _, evicted = _clients.popitem(last=False)
+            evicted.close()
+        return client
 
 
 @bp.route("/auth-url", methods=["GET"])
@@ -29,20 +53,14 @@ def generate_auth_url():
     hacm_path = request.args.get("hacm", "/var/lib/hacm/credentials.enc")
     redirect_uri = request.args.get("redirect_uri")
 
-    client = GmailOAuthClient(hacm_path, redirect_uri=redirect_uri)
-    state = request.args.get("state")
-
-    url = client.get_authorization_url(state=state)
+    client = get_client(hacm_path)
+    state = request.args.get("state") or client.generate_state()
 
-    # Extract state from URL for response
-    from urllib.parse import urlparse, parse_qs
-    parsed = urlparse(url)
-    params = parse_qs(parsed.query)
-    state_value = params.get("state", [""])[0]
+    url = client.get_authorization_url(state=state, redirect_uri=redirect_uri)
 
     return jsonify({
         "authorization_url": url,
-        "state": state_value,
+        "state": state,
         "redirect_uri": redirect_uri or "http://localhost:8080/callback",
     })
 
@@ -75,7 +93,7 @@ def handle_callback():
         client = get_client(hacm_path)
 
         # Exchange code for tokens
-        tokens = client.exchange_code_for_tokens(code, state)
+        tokens = client.exchange_code_for_tokens(code, state=state)
 
         # Extract account ID from token info if not provided
         # (Google doesn't return email in token response, so this is required)
@@ -139,7 +157,6 @@ def list_credentials():
         from hacm import CredentialStore
 
         store = CredentialStore(hacm_path)
-        creds = store.list()
 
         oauth_creds = [
             {
@@ -147,8 +164,7 @@ def list_credentials():
                 "provider": cred.provider,
                 "type": cred.type,
             }
-            for cred_id, cred in creds
-            if cred.provider == "google" and cred.type == "oauth_refresh"
+            for cred_id, cred in iter_google_credentials(store, "oauth_refresh")
         ]
 
         return jsonify({"credentials": oauth_creds})
@@ -3,37 +3,43 @@
 import argparse
 import sys
 
-from gmail_oauth import GmailOAuthClient, SimpleCallbackServer
+from gmail_oauth import GmailOAuthClient, SimpleCallbackServer, iter_google_credentials
 
 
 def cmd_auth_url(args):
     """Generate and display OAuth authorization URL."""
     client = GmailOAuthClient(args.hacm)
 
-    url = client.get_authorization_url()
+    state = client.generate_state()
+    url = client.get_authorization_url(state=state)
     print(f"\nVisit this URL to authorize the application:\n")
     print(f"  {url}\n")
 
     # Display state for verification
-    parsed = dict(x.split("=") for x in url.split("?")[1].split("&"))
-    print(f"State token (for verification): {parsed.get('state', 'N/A')}\n")
+    print(f"State token (for verification): {state}\n")
 
 
 def cmd_callback(args):
     """Run OAuth callback server and store tokens."""
     client = GmailOAuthClient(args.hacm)
 
+    # Use the state printed by auth-url, or issue a fresh URL with a new state
+    state = args.state
+    if state is None:
+        state = client.generate_state()
+        url = client.get_authorization_url(state=state)
+        print("\nVisit this URL to authorize the application:\n")
+        print(f"  {url}\n")
+
     # Start callback server
-    server = SimpleCallbackServer(args.port)
+    server = SimpleCallbackServer(args.port, expected_state=state)
 
     try:
-        # Wait for callback
+        # Wait for callback (raises ValueError on state mismatch)
         callback_data = server.wait_for_callback(timeout=args.timeout)
 
         # Exchange code for tokens
-        tokens = client.exchange_code_for_tokens(
-            callback_data["code"], callback_data.get("state")
-        )
+        tokens = client.exchange_code_for_tokens(callback_data["code"])
 
         # Store refresh token
         account_id = args.account or extract_email_from_token(tokens)
@@ -69,7 +75,7 @@ def cmd_list(args):
         from hacm import CredentialStore
 
         store = CredentialStore(args.hacm)
-        creds = store.list()
+        creds = list(iter_google_credentials(store))
 
         if not creds:
             print("\nNo OAuth credentials stored.")
@@ -82,6 +88,18 @@ def cmd_list(args):
             elif cred.type == "oauth_refresh":
                 print(f"  [token]  {cred.account_id}")
 
+        if args.refresh:
+            accounts = [cred.account_id for _, cred in creds if cred.type == "oauth_refresh"]
+            with GmailOAuthClient(args.hacm) as client:
+                results = client.refresh_all(accounts)
+
+            print("\nRefresh results:")
+            for account_id, result in results.items():
+                if isinstance(result, Exception):
+                    print(f"  [failed] {account_id}: {result}")
+                else:
+                    print(f"  [ok]     {account_id} (expires in {result.get('expires_in')}s)")
+
     except ImportError:
         print("\nHACM not installed: pip install memogarden-hacm", file=sys.stderr)
         sys.exit(1)
@@ -109,6 +127,7 @@ def main():
     callback_parser.add_argument("--port", type=int, default=8080, help="Callback server port")
     callback_parser.add_argument("--account", help="GMail account ID (e.g., user@gmail.com)")
     callback_parser.add_argument("--timeout", type=int, default=300, help="Timeout in seconds")
+    callback_parser.add_argument("--state", help="State token printed by auth-url (generated if omitted)")
     callback_parser.set_defaults(func=cmd_callback)
 
     # refresh command (test)
@@ -118,6 +137,7 @@ def main():
 
     # list command
     list_parser = subparsers.add_parser("list", help="List stored credentials")
+    list_parser.add_argument("--refresh", action="store_true", help="Refresh access tokens for all accounts")
     list_parser.set_defaults(func=cmd_list)
 
     args = parser.parse_args()
@@ -4,7 +4,6 @@
 import base64
 import json
 import os
-from datetime import datetime
 from urllib.parse import urlencode
 import secrets
 
@@ -32,7 +31,7 @@ def get_client_credentials():
         sys.exit(1)
 
     # Decode client credentials
-    creds_data = json.loads(base64.b64decode(client_cred.material).decode("utf-8"))
+    creds_data = json.loads(base64.b64decode(client_cred.material))
     return creds_data["client_id"]
 
 
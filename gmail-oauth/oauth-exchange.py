@@ -5,31 +5,52 @@ import base64
 import json
 import os
 import sys
-from datetime import datetime
+from datetime import datetime, timezone
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Configuration
 HACM_PATH = os.path.expanduser("~/hacm-test/credentials.enc")
 GOOGLE_TOKEN_URI = "https://oauth2.googleapis.com/token"
 
+# Shared session so token calls reuse the TLS connection. Only failed connects
+# are retried: the authorization code is single-use, so a request Google has
+# seen is never resent.
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(max_retries=Retry(
+    total=3, connect=3, read=0, status=0, other=0, backoff_factor=0.3, raise_on_status=False
+)))
+TOKEN_TIMEOUT = (3.05, 10)
+
+# HACM store, opened on first use by get_store()
+_store = None
+
+
+def get_store():
+    """Open the HACM store once; each open decrypts the credential file."""
+    global _store
+    if _store is None:
+        sys.path.insert(0, "/home/kureshii/memogarden/hacm")
+        from hacm import CredentialStore
+
+        _store = CredentialStore(HACM_PATH)
+    return _store
+
 
 def get_client_credentials():
     """Load client credentials from HACM."""
-    sys.path.insert(0, "/home/kureshii/memogarden/hacm")
-    from hacm import CredentialStore
-
-    store = CredentialStore(HACM_PATH)
+    store = get_store()
     client_cred = store.get("google:oauth-client")
 
-    creds_data = json.loads(base64.b64decode(client_cred.material).decode("utf-8"))
+    creds_data = json.loads(base64.b64decode(client_cred.material))
     return creds_data["client_id"], creds_data["client_secret"]
 
 
 def get_stored_credentials(account_id):
     """Load refresh token from HACM."""
-    sys.path.insert(0, "/home/kureshii/memogarden/hacm")
-    from hacm import CredentialStore
-
-    store = CredentialStore(HACM_PATH)
+    store = get_store()
     cred = store.get(f"google:{account_id}")
 
     if not cred:
@@ -41,11 +62,10 @@ def get_stored_credentials(account_id):
 
 def store_refresh_token(account_id, tokens):
     """Store refresh token in HACM."""
-    sys.path.insert(0, "/home/kureshii/memogarden/hacm")
-    from hacm import Credential, CredentialStore
-
-    store = CredentialStore(HACM_PATH)
+    store = get_store()
+    from hacm import Credential
 
+    now = datetime.now(timezone.utc)
     cred = Credential(
         id=f"google:{account_id}",
         provider="google",
@@ -57,8 +77,8 @@ def store_refresh_token(account_id, tokens):
             "token_endpoint": GOOGLE_TOKEN_URI,
             "access_expires_in": tokens.get("expires_in"),
         },
-        created_at=datetime.utcnow(),
-        updated_at=datetime.utcnow(),
+        created_at=now,
+        updated_at=now,
     )
 
     store.put(f"google:{account_id}", cred)
@@ -88,8 +108,7 @@ def main():
         "grant_type": "authorization_code",
     }
 
-    import requests
-    response = requests.post(GOOGLE_TOKEN_URI, data=data)
+    response = SESSION.post(GOOGLE_TOKEN_URI, data=data, timeout=TOKEN_TIMEOUT)
     response.raise_for_status()
 
     tokens = response.json()
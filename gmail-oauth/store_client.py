@@ -3,7 +3,7 @@
 import base64
 import json
 import sys
-from datetime import datetime
+from datetime import datetime, timezone
 
 # Add hacm to path if running locally
 sys.path.insert(0, "/home/kureshii/memogarden/hacm")
@@ -39,6 +39,7 @@ material = base64.b64encode(
 ).decode()
 
 # Create credential
+now = datetime.now(timezone.utc)
 cred = Credential(
     id="google:oauth-client",
     provider="google",
@@ -50,8 +51,8 @@ cred = Credential(
         "auth_uri": "https://accounts.google.com/o/oauth2/auth",
         "token_uri": "https://oauth2.googleapis.com/token"
     },
-    created_at=datetime.utcnow(),
-    updated_at=datetime.utcnow()
+    created_at=now,
+    updated_at=now
 )
 
 # Store in HACM
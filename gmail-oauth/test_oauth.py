@@ -1,5 +1,6 @@
 """Placeholder tests for GMail OAuth flow."""
 
+import re
 import tempfile
 
 
@@ -22,8 +23,8 @@ def test_state_generation():
     """Test that state parameter is generated and unique."""
     from gmail_oauth import GmailOAuthClient
 
-    state1 = GmailOAuthClient._generate_state()
-    state2 = GmailOAuthClient._generate_state()
+    state1 = GmailOAuthClient.generate_state()
+    state2 = GmailOAuthClient.generate_state()
 
     assert state1 != state2
     assert len(state1) > 16
@@ -33,9 +34,321 @@ def test_state_is_url_safe():
     """Test that state parameter is URL-safe."""
     from gmail_oauth import GmailOAuthClient
 
-    state = GmailOAuthClient._generate_state()
+    state = GmailOAuthClient.generate_state()
 
-    # Should not contain URL-unsafe characters
-    assert "-" in state or "_" in state
-    # Should be base64-like
+    # Should only use the URL-safe base64 alphabet
+    assert re.fullmatch(r"[A-Za-z0-9_-]+", state)
     assert len(state) >= 16
+
+
+def test_client_context_manager_closes_session():
+    """Test that the client closes its pooled session on exit."""
+    from gmail_oauth import GmailOAuthClient
+
+    closed = []
+    with GmailOAuthClient("unused.enc", client_id="test_id", client_secret="test_secret") as client:
+        client._session.close = lambda: closed.append(True)
+
+    assert closed == [True]
+
+
+def test_access_token_cached_until_near_expiry():
+    """Test that a valid access token is served without refreshing."""
+    from gmail_oauth import GmailOAuthClient
+
+    client = GmailOAuthClient("unused.enc", client_id="test_id", client_secret="test_secret")
+    calls = []
+
+    def fake_refresh(account_id):
+        calls.append(account_id)
+        return {"access_token": f"token-{len(calls)}", "expires_in": 3600}
+
+    client.refresh_access_token = fake_refresh
+
+    assert client.get_valid_access_token("user@gmail.com") == "token-1"
+    assert client.get_valid_access_token("user@gmail.com") == "token-1"
+    assert calls == ["user@gmail.com"]
+
+    # Within the skew window the token is refreshed
+    assert client.get_valid_access_token("user@gmail.com", skew_seconds=3600) == "token-2"
+
+
+def test_concurrent_refreshes_share_one_request():
+    """Test that concurrent refreshes for one account POST only once."""
+    import threading
+
+    from gmail_oauth import GmailOAuthClient
+
+    client = GmailOAuthClient("unused.enc", client_id="test_id", client_secret="test_secret")
+    lookups = threading.Semaphore(0)
+    release = threading.Event()
+    calls = []
+
+    class CountingDict(dict):
+        """In-flight map that signals every lookup made under the refresh lock."""
+
+        def get(self, key, default=None):
+            value = super().get(key, default)
+            lookups.release()
+            return value
+
+    def fake_request(account_id):
+        calls.append(account_id)
+        release.wait(timeout=5)
+        return {"access_token": "token", "expires_in": 3600}
+
+    client._refresh_inflight = CountingDict()
+    client._request_refresh = fake_request
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(client.refresh_access_token("user@gmail.com")))
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+
+    # The owner blocks in fake_request until release, so once all four threads
+    # have looked up the in-flight map the other three hold its Future.
+    for _ in threads:
+        assert lookups.acquire(timeout=5)
+    release.set()
+    for thread in threads:
+        thread.join(timeout=5)
+
+    assert calls == ["user@gmail.com"]
+    assert len(results) == 4
+    assert all(r["access_token"] == "token" for r in results)
+
+
+def _run_callback(query: str, expected_state: str | None = None) -> dict:
+    """Run SimpleCallbackServer against one request; return result or error."""
+    import socket
+    import threading
+    import urllib.error
+    import urllib.request
+
+    from gmail_oauth import SimpleCallbackServer
+
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        port = sock.getsockname()[1]
+
+    server = SimpleCallbackServer(port, expected_state=expected_state)
+    result = {}
+
+    def wait():
+        try:
+            result.update(server.wait_for_callback(timeout=5))
+        except (ValueError, TimeoutError) as e:
+            result["error"] = str(e)
+
+    waiter = threading.Thread(target=wait)
+    waiter.start()
+
+    for _ in range(50):
+        try:
+            urllib.request.urlopen(f"http://localhost:{port}/callback?{query}", timeout=1).read()
+            break
+        except urllib.error.HTTPError:
+            break
+        except OSError:
+            threading.Event().wait(0.05)
+    waiter.join(timeout=5)
+    return result
+
+
+def test_callback_server_returns_code():
+    """Test that the callback server returns the code from the redirect."""
+    result = _run_callback("code=test_code&state=test_state", expected_state="test_state")
+    assert result == {"code": "test_code", "state": "test_state"}
+
+
+def test_callback_server_rejects_state_mismatch():
+    """Test that a callback with the wrong state never yields a code."""
+    result = _run_callback("code=test_code&state=forged", expected_state="test_state")
+    assert result == {"error": "OAuth error: state_mismatch"}
+
+
+def test_credential_store_opened_per_operation(monkeypatch):
+    """Test that each HACM operation opens a fresh store."""
+    import gmail_oauth
+    from gmail_oauth import GmailOAuthClient
+
+    opened = []
+    monkeypatch.setattr(gmail_oauth, "_HACM_AVAILABLE", True)
+    monkeypatch.setattr(
+        gmail_oauth, "CredentialStore", lambda path: opened.append(path) or object(), raising=False
+    )
+
+    client = GmailOAuthClient("store.enc")
+    assert client._open_store() is not client._open_store()
+    assert opened == ["store.enc", "store.enc"]
+
+
+def test_iter_google_credentials_filters_provider_and_type():
+    """Test that only Google credentials of the requested type are yielded."""
+    from types import SimpleNamespace
+
+    from gmail_oauth import iter_google_credentials
+
+    creds = [
+        ("google:oauth-client", SimpleNamespace(type="oauth_client")),
+        ("google:user@gmail.com", SimpleNamespace(type="oauth_refresh")),
+        ("github:user", SimpleNamespace(type="oauth_refresh")),
+    ]
+    store = SimpleNamespace(list=lambda: creds)
+
+    assert [cid for cid, _ in iter_google_credentials(store)] == [
+        "google:oauth-client",
+        "google:user@gmail.com",
+    ]
+    assert [cid for cid, _ in iter_google_credentials(store, "oauth_refresh")] == [
+        "google:user@gmail.com",
+    ]
+
+
+def test_client_credentials_decoded_once():
+    """Test that client credentials are read from HACM only once."""
+    import base64
+    import json
+    from types import SimpleNamespace
+
+    from gmail_oauth import GmailOAuthClient
+
+    material = base64.b64encode(
+        json.dumps({"client_id": "hacm_id", "client_secret": "hacm_secret"}).encode()
+    ).decode()
+    reads = []
+
+    def fake_get(cred_id):
+        reads.append(cred_id)
+        return SimpleNamespace(material=material)
+
+    client = GmailOAuthClient("unused.enc")
+    client._open_store = lambda: SimpleNamespace(get=fake_get)
+
+    assert client.get_client_credentials() == ("hacm_id", "hacm_secret")
+    assert client.get_client_credentials() == ("hacm_id", "hacm_secret")
+    assert reads == ["google:oauth-client"]
+
+
+def test_refresh_all_collects_results_and_errors():
+    """Test that refresh_all returns tokens or the exception per account."""
+    from gmail_oauth import GmailOAuthClient
+
+    client = GmailOAuthClient("unused.enc", client_id="test_id", client_secret="test_secret")
+
+    def fake_refresh(account_id):
+        if account_id == "bad@gmail.com":
+            raise ValueError("No refresh token found for bad@gmail.com")
+        return {"access_token": f"token-{account_id}", "expires_in": 3600}
+
+    client.refresh_access_token = fake_refresh
+
+    results = client.refresh_all(["a@gmail.com", "bad@gmail.com"])
+
+    assert results["a@gmail.com"]["access_token"] == "token-a@gmail.com"
+    assert isinstance(results["bad@gmail.com"], ValueError)
+    assert client.refresh_all([]) == {}
+
+    # Successful refreshes warm the access token cache
+    client.refresh_access_token = None
+    assert client.get_valid_access_token("a@gmail.com") == "token-a@gmail.com"
+
+
+def test_callback_server_reports_provider_error():
+    """Test that an error redirect is surfaced with its description."""
+    result = _run_callback("error=access_denied&error_description=User+denied")
+    assert result == {"error": "OAuth error: access_denied: User denied"}
+
+
+def test_store_tokens_uses_one_aware_timestamp(monkeypatch):
+    """Test that created_at and updated_at are the same UTC-aware instant."""
+    from datetime import timezone
+    from types import SimpleNamespace
+
+    import gmail_oauth
+    from gmail_oauth import GmailOAuthClient
+
+    stored = {}
+    monkeypatch.setattr(gmail_oauth, "Credential", SimpleNamespace, raising=False)
+
+    client = GmailOAuthClient("unused.enc")
+    client._open_store = lambda: SimpleNamespace(put=stored.__setitem__)
+    client.store_tokens("user@gmail.com", {"refresh_token": "r", "scope": "a b", "expires_in": 3599})
+
+    cred = stored["google:user@gmail.com"]
+    assert cred.created_at is cred.updated_at
+    assert cred.created_at.tzinfo is timezone.utc
+
+
+def test_token_exchange_not_resent_after_error_status(monkeypatch):
+    """Test that a 5xx answer to a code exchange is not retried."""
+    import threading
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+    import pytest
+    import requests
+
+    import gmail_oauth
+    from gmail_oauth import GmailOAuthClient
+
+    posts = []
+
+    class TokenHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            posts.append(self.rfile.read(int(self.headers["Content-Length"])))
+            self.send_response(500)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("localhost", 0), TokenHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(gmail_oauth, "GOOGLE_TOKEN_URI", f"http://localhost:{server.server_port}/token")
+
+    client = GmailOAuthClient("unused.enc", client_id="test_id", client_secret="test_secret")
+    client._session.mount("http://", client._session.get_adapter("https://oauth2.googleapis.com"))
+    try:
+        with pytest.raises(requests.HTTPError):
+            client.exchange_code_for_tokens("single-use")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert len(posts) == 1
+
+
+def test_endpoint_clients_shared_per_hacm_path_and_closed_on_eviction(monkeypatch):
+    """Test that Flask endpoints share one client per HACM path."""
+    import pytest
+
+    pytest.importorskip("flask")
+    from gmail_oauth import endpoints
+
+    monkeypatch.setattr(endpoints, "_clients", type(endpoints._clients)())
+    monkeypatch.setattr(endpoints, "_MAX_CLIENTS", 1)
+
+    first = endpoints.get_client("a.enc")
+    assert endpoints.get_client("a.enc") is first
+
+    closed = []
+    first.close = lambda: closed.append(True)
+    endpoints.get_client("b.enc")
+    assert closed == [True]
+
+
+def test_authorization_url_redirect_override():
+    """Test that a per-call redirect URI overrides the client default."""
+    from urllib.parse import parse_qs, urlsplit
+
+    from gmail_oauth import GmailOAuthClient
+
+    client = GmailOAuthClient("unused.enc", client_id="test_id", client_secret="test_secret")
+    url = client.get_authorization_url(state="s", redirect_uri="http://localhost:9090/callback")
+
+    assert parse_qs(urlsplit(url).query)["redirect_uri"] == ["http://localhost:9090/callback"]
+    assert client.redirect_uri == "http://localhost:8080/callback"
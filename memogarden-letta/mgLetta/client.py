@@ -5,7 +5,7 @@ the state into Letta-compatible memory blocks.
 """
 
 import asyncio
-from dataclasses import dataclass, field
+from dataclasses import dataclass
 from typing import Any, Optional
 
 from mg_client import MemoGardenClient